@@ -3,27 +3,71 @@ from unittest.mock import patch, MagicMock
 
 import numpy as np
 import scipy.sparse as sp
-from scipy.spatial.distance import pdist, cdist, squareform
 import pynndescent
 import hnswlib
 from sklearn import datasets
 
-from numba import njit
+from numba import njit, types
 from numba.core.registry import CPUDispatcher
 from sklearn.utils import check_random_state
 
 from openTSNE import nearest_neighbors
 from .test_tsne import check_mock_called_with_kwargs
 
+IRIS = datasets.load_iris().data
+
+
+def manhattan(x, y):
+    # Use a scalar accumulator instead of calling `np.abs` for every element.
+    # This avoids a ufunc dispatch per element when called from Python, and
+    # lets numba vectorize the reduction when compiled
+    result = 0.0
+    for i in range(x.shape[0]):
+        d = x[i] - y[i]
+        result += d if d >= 0 else -d
+
+    return result
+
+
+# Compile up front for the rows the backends pass to the metric: scikit-learn
+# works in double precision, while pynndescent casts its data to float32. The
+# rows are typed as read-only so that writeable arrays are accepted as well. The
+# sum is kept in double precision to match pynndescent's own manhattan metric.
+# Compilation stays lazy, so any other row type, e.g. a non-contiguous view,
+# still gets compiled on first use instead of raising a typing error
+manhattan_numba = njit(fastmath=True, cache=True, boundscheck=False)(manhattan)
+for _dtype in (types.float32, types.float64):
+    _row = types.Array(_dtype, 1, "C", readonly=True)
+    manhattan_numba.compile(types.float64(_row, _row))
+
+
+class MockNNDescent:
+    """A stand-in for `pynndescent.NNDescent` which skips the actual search and
+    returns a random neighbor graph. Useful for tests that only check which
+    parameters get passed through."""
+
+    def __init__(self, data, n_neighbors, **_):
+        n_samples = data.shape[0]
+
+        rs = check_random_state(0)
+        indices = rs.randint(0, n_samples, size=(n_samples, n_neighbors))
+        distances = rs.exponential(5, (n_samples, n_neighbors))
+
+        self.neighbor_graph = indices, distances
+
 
 class KNNIndexTestMixin:
     knn_index = NotImplemented
 
-    def __init__(self, *args, **kwargs):
-        self.x1 = np.random.normal(100, 50, (150, 50))
-        self.x2 = np.random.normal(100, 50, (100, 50))
-        self.iris = datasets.load_iris().data
-        super().__init__(*args, **kwargs)
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rng = np.random.default_rng(12345)
+        # Annoy, HNSW and pynndescent work in single precision; BallTree casts
+        # to float64
+        cls.x1 = rng.standard_normal((150, 50), dtype=np.float32) * 50 + 100
+        cls.x2 = rng.standard_normal((100, 50), dtype=np.float32) * 50 + 100
+        cls.iris = IRIS
 
     def test_returns_correct_number_neighbors_query_train(self):
         ks = [1, 5, 10, 30, 50]
@@ -52,126 +96,146 @@ class KNNIndexTestMixin:
             self.assertEqual(distances.shape, (n_samples, k))
 
     def test_query_train_same_result_with_fixed_random_state(self):
-        knn_index1 = self.knn_index("euclidean", random_state=1)
-        indices1, distances1 = knn_index1.build(self.x1, k=20)
-
-        knn_index2 = self.knn_index("euclidean", random_state=1)
-        indices2, distances2 = knn_index2.build(self.x1, k=20)
+        for k in (20, 30):
+            with self.subTest(k=k):
+                knn_index1 = self.knn_index("euclidean", random_state=1)
+                indices1, distances1 = knn_index1.build(self.x1, k=k)
 
-        np.testing.assert_equal(indices1, indices2)
-        np.testing.assert_equal(distances1, distances2)
+                knn_index2 = self.knn_index("euclidean", random_state=1)
+                indices2, distances2 = knn_index2.build(self.x1, k=k)
 
-    def test_query_same_result_with_fixed_random_state(self):
-        knn_index1 = self.knn_index("euclidean", random_state=1)
-        indices1, distances1 = knn_index1.build(self.x1, k=30)
+                np.testing.assert_equal(indices1, indices2)
+                np.testing.assert_equal(distances1, distances2)
 
-        knn_index2 = self.knn_index("euclidean", random_state=1)
-        indices2, distances2 = knn_index2.build(self.x1, k=30)
 
-        np.testing.assert_equal(indices1, indices2)
-        np.testing.assert_equal(distances1, distances2)
+class CallableMetricTestMixin(KNNIndexTestMixin):
+    """Tests for backends accepting callable metrics, which compare a callable
+    manhattan metric against the backend's built-in one."""
 
+    callable_metric_k = 15
+    _manhattan_truth = None
 
-class TestAnnoy(KNNIndexTestMixin, unittest.TestCase):
-    knn_index = nearest_neighbors.Annoy
+    def manhattan_truth(self):
+        """Reference neighbors from the built-in manhattan metric. These are
+        built on first use and then shared by the test class, so a failing
+        build only fails the tests that need them."""
+        cls = type(self)
+        if cls._manhattan_truth is None:
+            k = self.callable_metric_k
+            knn_index = self.knn_index("manhattan", random_state=1)
+            knn_index.build(self.x1, k=k)
+            cls._manhattan_truth = knn_index.query(self.x2, k=k)
 
+        return cls._manhattan_truth
 
-class TestHNSW(KNNIndexTestMixin, unittest.TestCase):
-    knn_index = nearest_neighbors.HNSW
-
-
-class TestBallTree(KNNIndexTestMixin, unittest.TestCase):
-    knn_index = nearest_neighbors.BallTree
-
-    def test_cosine_distance(self):
-        k = 15
-        # Compute cosine distance nearest neighbors using ball tree
-        knn_index = nearest_neighbors.BallTree("cosine")
-        indices, distances = knn_index.build(self.x1, k=k)
+    def test_uncompiled_callable_metric_same_result(self):
+        k = self.callable_metric_k
 
-        # Compute the exact nearest neighbors as a reference
-        true_distances = squareform(pdist(self.x1, metric="cosine"))
-        true_indices_ = np.argsort(true_distances, axis=1)[:, 1:k + 1]
-        true_distances_ = np.vstack([d[i] for d, i in zip(true_distances, true_indices_)])
+        true_indices_, true_distances_ = self.manhattan_truth()
 
+        knn_index = self.knn_index(manhattan, random_state=1)
+        knn_index.build(self.x1, k=k)
+        indices, distances = knn_index.query(self.x2, k=k)
         np.testing.assert_array_equal(
             indices, true_indices_, err_msg="Nearest neighbors do not match"
         )
-        np.testing.assert_array_equal(
+        np.testing.assert_allclose(
             distances, true_distances_, err_msg="Distances do not match"
         )
 
-    def test_cosine_distance_query(self):
-        k = 15
-        # Compute cosine distance nearest neighbors using ball tree
-        knn_index = nearest_neighbors.BallTree("cosine")
-        knn_index.build(self.x1, k=k)
+    def test_numba_compiled_callable_metric_same_result(self):
+        k = self.callable_metric_k
 
-        indices, distances = knn_index.query(self.x2, k=k)
-
-        # Compute the exact nearest neighbors as a reference
-        true_distances = cdist(self.x2, self.x1, metric="cosine")
-        true_indices_ = np.argsort(true_distances, axis=1)[:, :k]
-        true_distances_ = np.vstack([d[i] for d, i in zip(true_distances, true_indices_)])
+        true_indices_, true_distances_ = self.manhattan_truth()
 
+        knn_index = self.knn_index(manhattan_numba, random_state=1)
+        knn_index.build(self.x1, k=k)
+        indices, distances = knn_index.query(self.x2, k=k)
         np.testing.assert_array_equal(
             indices, true_indices_, err_msg="Nearest neighbors do not match"
         )
-        np.testing.assert_array_equal(
+        np.testing.assert_allclose(
             distances, true_distances_, err_msg="Distances do not match"
         )
 
-    def test_uncompiled_callable_metric_same_result(self):
-        k = 15
 
-        knn_index = self.knn_index("manhattan", random_state=1)
-        knn_index.build(self.x1, k=k)
-        true_indices_, true_distances_ = knn_index.query(self.x2, k=k)
+class TestAnnoy(KNNIndexTestMixin, unittest.TestCase):
+    knn_index = nearest_neighbors.Annoy
 
-        def manhattan(x, y):
-            result = 0.0
-            for i in range(x.shape[0]):
-                result += np.abs(x[i] - y[i])
 
-            return result
+class TestHNSW(KNNIndexTestMixin, unittest.TestCase):
+    knn_index = nearest_neighbors.HNSW
+
+
+class TestBallTree(CallableMetricTestMixin, unittest.TestCase):
+    knn_index = nearest_neighbors.BallTree
+
+    def test_cosine_distance(self):
+        k = 15
+        # Compare against the exact reference in double precision, so rounding
+        # errors can't reorder near-tied neighbors
+        x1 = self.x1.astype(np.float64)
+
+        # Compute cosine distance nearest neighbors using ball tree
+        knn_index = nearest_neighbors.BallTree("cosine")
+        indices, distances = knn_index.build(x1, k=k)
+
+        # Compute the exact nearest neighbors as a reference
+        x1_normed = x1 / np.linalg.norm(x1, axis=1, keepdims=True)
+        true_distances = 1 - x1_normed @ x1_normed.T
+        # Only the k + 1 closest points (including the point itself) need to
+        # be sorted
+        rows = np.arange(true_distances.shape[0])[:, None]
+        candidates = np.argpartition(true_distances, kth=k, axis=1)[:, :k + 1]
+        order = np.argsort(true_distances[rows, candidates], axis=1)
+        true_indices_ = candidates[rows, order][:, 1:]
+        true_distances_ = true_distances[rows, true_indices_]
 
-        knn_index = self.knn_index(manhattan, random_state=1)
-        knn_index.build(self.x1, k=k)
-        indices, distances = knn_index.query(self.x2, k=k)
         np.testing.assert_array_equal(
             indices, true_indices_, err_msg="Nearest neighbors do not match"
         )
+        # The reference sums in a different order, so allow for rounding
         np.testing.assert_allclose(
-            distances, true_distances_, err_msg="Distances do not match"
+            distances,
+            true_distances_,
+            rtol=1e-6,
+            atol=0,
+            err_msg="Distances do not match",
         )
 
-    def test_numba_compiled_callable_metric_same_result(self):
+    def test_cosine_distance_query(self):
         k = 15
+        x1, x2 = self.x1.astype(np.float64), self.x2.astype(np.float64)
 
-        knn_index = self.knn_index("manhattan", random_state=1)
-        knn_index.build(self.x1, k=k)
-        true_indices_, true_distances_ = knn_index.query(self.x2, k=k)
+        # Compute cosine distance nearest neighbors using ball tree
+        knn_index = nearest_neighbors.BallTree("cosine")
+        knn_index.build(x1, k=k)
 
-        @njit(fastmath=True)
-        def manhattan(x, y):
-            result = 0.0
-            for i in range(x.shape[0]):
-                result += np.abs(x[i] - y[i])
+        indices, distances = knn_index.query(x2, k=k)
 
-            return result
+        # Compute the exact nearest neighbors as a reference
+        x1_normed = x1 / np.linalg.norm(x1, axis=1, keepdims=True)
+        x2_normed = x2 / np.linalg.norm(x2, axis=1, keepdims=True)
+        true_distances = 1 - x2_normed @ x1_normed.T
+        rows = np.arange(true_distances.shape[0])[:, None]
+        candidates = np.argpartition(true_distances, kth=k - 1, axis=1)[:, :k]
+        order = np.argsort(true_distances[rows, candidates], axis=1)
+        true_indices_ = candidates[rows, order]
+        true_distances_ = true_distances[rows, true_indices_]
 
-        knn_index = self.knn_index(manhattan, random_state=1)
-        knn_index.build(self.x1, k=k)
-        indices, distances = knn_index.query(self.x2, k=k)
         np.testing.assert_array_equal(
             indices, true_indices_, err_msg="Nearest neighbors do not match"
         )
         np.testing.assert_allclose(
-            distances, true_distances_, err_msg="Distances do not match"
+            distances,
+            true_distances_,
+            rtol=1e-6,
+            atol=0,
+            err_msg="Distances do not match",
         )
 
 
-class TestNNDescent(KNNIndexTestMixin, unittest.TestCase):
+class TestNNDescent(CallableMetricTestMixin, unittest.TestCase):
     knn_index = nearest_neighbors.NNDescent
 
     @patch("pynndescent.NNDescent", wraps=pynndescent.NNDescent)
@@ -186,65 +250,9 @@ class TestNNDescent(KNNIndexTestMixin, unittest.TestCase):
     def test_uncompiled_callable_is_compiled(self):
         knn_index = nearest_neighbors.NNDescent("manhattan")
 
-        def manhattan(x, y):
-            result = 0.0
-            for i in range(x.shape[0]):
-                result += np.abs(x[i] - y[i])
-
-            return result
-
         compiled_metric = knn_index.check_metric(manhattan)
         self.assertTrue(isinstance(compiled_metric, CPUDispatcher))
 
-    def test_uncompiled_callable_metric_same_result(self):
-        k = 15
-
-        knn_index = self.knn_index("manhattan", random_state=1)
-        knn_index.build(self.x1, k=k)
-        true_indices_, true_distances_ = knn_index.query(self.x2, k=k)
-
-        def manhattan(x, y):
-            result = 0.0
-            for i in range(x.shape[0]):
-                result += np.abs(x[i] - y[i])
-
-            return result
-
-        knn_index = self.knn_index(manhattan, random_state=1)
-        knn_index.build(self.x1, k=k)
-        indices, distances = knn_index.query(self.x2, k=k)
-        np.testing.assert_array_equal(
-            indices, true_indices_, err_msg="Nearest neighbors do not match"
-        )
-        np.testing.assert_allclose(
-            distances, true_distances_, err_msg="Distances do not match"
-        )
-
-    def test_numba_compiled_callable_metric_same_result(self):
-        k = 15
-
-        knn_index = self.knn_index("manhattan", random_state=1)
-        knn_index.build(self.x1, k=k)
-        true_indices_, true_distances_ = knn_index.query(self.x2, k=k)
-
-        @njit(fastmath=True)
-        def manhattan(x, y):
-            result = 0.0
-            for i in range(x.shape[0]):
-                result += np.abs(x[i] - y[i])
-
-            return result
-
-        knn_index = self.knn_index(manhattan, random_state=1)
-        knn_index.build(self.x1, k=k)
-        indices, distances = knn_index.query(self.x2, k=k)
-        np.testing.assert_array_equal(
-            indices, true_indices_, err_msg="Nearest neighbors do not match"
-        )
-        np.testing.assert_allclose(
-            distances, true_distances_, err_msg="Distances do not match"
-        )
-
     @patch("pynndescent.NNDescent", wraps=pynndescent.NNDescent)
     def test_building_with_lt15_builds_proper_graph(self, nndescent):
         knn_index = nearest_neighbors.NNDescent("euclidean")
@@ -274,41 +282,46 @@ class TestNNDescent(KNNIndexTestMixin, unittest.TestCase):
         # which we don't consider.
         check_mock_called_with_kwargs(nndescent.query, dict(k=31))
 
-    @patch("pynndescent.NNDescent", wraps=pynndescent.NNDescent)
+    @patch("pynndescent.NNDescent", wraps=MockNNDescent)
     def test_runs_with_correct_njobs_if_dense_input(self, nndescent):
         knn_index = nearest_neighbors.NNDescent("euclidean", n_jobs=2)
         knn_index.build(self.x1, k=5)
         check_mock_called_with_kwargs(nndescent, dict(n_jobs=2))
 
-    @patch("pynndescent.NNDescent", wraps=pynndescent.NNDescent)
+    @patch("pynndescent.NNDescent", wraps=MockNNDescent)
     def test_runs_with_correct_njobs_if_sparse_input(self, nndescent):
         x_sparse = sp.csr_matrix(self.x1)
         knn_index = nearest_neighbors.NNDescent("euclidean", n_jobs=2)
         knn_index.build(x_sparse, k=5)
         check_mock_called_with_kwargs(nndescent, dict(n_jobs=2))
 
-    def test_random_cluster_when_invalid_indices(self):
-        class MockIndex:
-            def __init__(self, data, n_neighbors, **_):
-                n_samples = data.shape[0]
+    def test_builds_from_sparse_input(self):
+        x_sparse = sp.csr_matrix(self.x1)
+        knn_index = nearest_neighbors.NNDescent("euclidean")
+        indices, distances = knn_index.build(x_sparse, k=5)
 
-                rs = check_random_state(0)
-                indices = rs.randint(0, n_samples, size=(n_samples, n_neighbors))
-                distances = rs.exponential(5, (n_samples, n_neighbors))
+        self.assertEqual(indices.shape, (self.x1.shape[0], 5))
+        self.assertEqual(distances.shape, (self.x1.shape[0], 5))
+        self.assertTrue(np.isfinite(distances).all())
+
+    def test_random_cluster_when_invalid_indices(self):
+        class MockIndex(MockNNDescent):
+            def __init__(self, data, n_neighbors, **kwargs):
+                super().__init__(data, n_neighbors, **kwargs)
+                indices, distances = self.neighbor_graph
 
                 # Set some of the points to have invalid indices
                 indices[:10] = -1
                 distances[:10] = -1
 
-                self.neighbor_graph = indices, distances
-
         with patch("pynndescent.NNDescent", wraps=MockIndex):
             knn_index = nearest_neighbors.NNDescent("euclidean", n_jobs=2)
             indices, distances = knn_index.build(self.x1, k=5)
 
             # Check that indices were replaced by something
-            self.assertTrue(np.all(indices[:10] != -1))
+            self.assertTrue((indices[:10] != -1).all())
             # Check that that "something" are all indices of failed points
-            self.assertTrue(np.all(indices[:10] < 10))
+            self.assertGreaterEqual(indices[:10].min(), 0)
+            self.assertLess(indices[:10].max(), 10)
             # And check that the distances were set to something positive
-            self.assertTrue(np.all(distances[:10] > 0))
+            self.assertGreater(distances[:10].min(), 0)